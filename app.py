@@ -5,29 +5,35 @@ PDF/이미지를 편집 가능한 PPTX로 변환하는 API 서버
 
 import os
 import sys
+import json
 import uuid
 import shutil
+import hashlib
 import traceback
 from datetime import datetime
 from flask import Flask, request, jsonify, send_file, render_template
 from dotenv import load_dotenv
+from celery import Celery
 from werkzeug.utils import secure_filename
 
+# 환경변수 로드 (modules가 import 시점에 읽는 설정이 .env를 반영하도록 먼저 실행)
+load_dotenv()
+
 from modules.pdf_processor import (
     extract_from_pdf,
-    pdf_pages_to_images,
-    images_to_slide_data,
+    iter_pdf_pages,
+    iter_images,
+    PageAccessor,
 )
-from modules.ai_analyzer import analyze_slides_batch
+from modules.ai_analyzer import analyze_slides_grouped, PROMPT_VERSION
 from modules.pptx_builder import (
     build_pptx_from_pdf_data,
     build_pptx_from_ai_data,
     build_pptx_with_background_images,
+    PPTX_JPEG_QUALITY,
+    USE_FAST_PPTX,
 )
 
-# 환경변수 로드
-load_dotenv()
-
 # stdout 인코딩 설정 (Windows CP949 대응)
 if sys.platform == "win32":
     sys.stdout.reconfigure(encoding="utf-8", errors="replace")
@@ -36,10 +42,26 @@ if sys.platform == "win32":
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB 제한
 app.config["UPLOAD_FOLDER"] = os.path.join(os.path.dirname(__file__), "uploads")
+app.config["RESULT_CACHE_FOLDER"] = os.path.join(app.config["UPLOAD_FOLDER"], ".result_cache")
+app.config["RESULT_CACHE_MAX_AGE"] = 7 * 24 * 3600  # 7일 동안 사용되지 않은 결과는 삭제
+app.config["RESULT_CACHE_MAX_BYTES"] = 500 * 1024 * 1024  # 총 500MB 초과 시 가장 오래 안 쓴 것부터 삭제
+
+# PPTX 생성 방식(빌더 코드, 이미지 형식 등)을 바꾸면 올려서 기존 결과 캐시를 무효화
+RESULT_CACHE_VERSION = "1"
+
+# 작업 큐 (REDIS_URL이 없으면 요청 안에서 동기 변환)
+REDIS_URL = os.environ.get("REDIS_URL", "").strip()
+celery_app = Celery("noteslide", broker=REDIS_URL, backend=REDIS_URL) if REDIS_URL else None
 
 # 허용 확장자
 ALLOWED_EXTENSIONS = {"pdf", "png", "jpg", "jpeg"}
 
+# 이보다 작은 요청은 업로드 파일을 디스크에 저장하지 않고 메모리에서 바로 처리
+IN_MEMORY_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+# AI 분석/이미지 폴백용 PDF 렌더링 해상도
+PAGE_RENDER_DPI = 200
+
 
 def log(msg):
     """서버 로그 출력"""
@@ -51,20 +73,256 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def iter_page_images(pdf_path):
+    """PDF 페이지 이미지를 한 장씩 생성 (전체 목록을 메모리에 두지 않음)"""
+    return (img for _, img in iter_pdf_pages(pdf_path, dpi=PAGE_RENDER_DPI))
+
+
 def ensure_upload_dir():
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
 
+def result_cache_key(sources, use_ai):
+    """
+    업로드 파일 내용 + 결과 캐시/프롬프트 버전 + 렌더링 설정 + AI 사용 여부(API 키)로 결과 캐시 키 생성
+    같은 입력에 대해 변환 파이프라인은 결정적이므로 완성된 PPTX를 재사용할 수 있음
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for source in sources:
+        if isinstance(source, bytes):
+            h.update(source)
+        else:
+            with open(source, "rb") as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    h.update(chunk)
+        h.update(b"\0")
+    api_key = os.environ.get("GEMINI_API_KEY", "").strip()
+    key_salt = hashlib.blake2b(api_key[:8].encode(), digest_size=4).hexdigest() if use_ai else ""
+    h.update(f"{RESULT_CACHE_VERSION}:{PROMPT_VERSION}:{PAGE_RENDER_DPI}:{USE_FAST_PPTX}:"
+             f"{PPTX_JPEG_QUALITY}:{use_ai}:{key_salt}".encode())
+    return h.hexdigest()
+
+
+def load_cached_result(cache_key, output_path):
+    """캐시된 PPTX를 output_path로 복사하고 메타데이터 반환 (없으면 None)"""
+    base = os.path.join(app.config["RESULT_CACHE_FOLDER"], cache_key)
+    try:
+        with open(base + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        shutil.copyfile(base + ".pptx", output_path)
+        # 적중 시각을 기록하여 정리 시 최근에 쓴 항목을 남김 (LRU)
+        os.utime(base + ".pptx")
+        return meta
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_result(cache_key, output_path, meta):
+    """변환 결과를 캐시에 저장 (임시 파일 → rename으로 원자적 기록)"""
+    cache_dir = app.config["RESULT_CACHE_FOLDER"]
+    base = os.path.join(cache_dir, cache_key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{base}.{uuid.uuid4().hex[:8]}.tmp"
+        shutil.copyfile(output_path, tmp)
+        os.replace(tmp, base + ".pptx")
+        # 메타데이터가 있어야 적중으로 간주하므로 PPTX 다음에 기록
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, base + ".json")
+    except OSError as e:
+        log(f"결과 캐시 저장 실패: {e}")
+    prune_result_cache()
+
+
+def prune_result_cache():
+    """오래 사용되지 않았거나 총 용량을 넘는 결과 캐시 항목 삭제 (마지막 사용이 오래된 것부터)"""
+    cache_dir = app.config["RESULT_CACHE_FOLDER"]
+    try:
+        names = [n for n in os.listdir(cache_dir) if n.endswith(".pptx")]
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name[:-len(".pptx")]))
+    entries.sort()
+
+    now = datetime.now().timestamp()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, key in entries:
+        if now - mtime <= app.config["RESULT_CACHE_MAX_AGE"] and total <= app.config["RESULT_CACHE_MAX_BYTES"]:
+            break
+        # 메타데이터를 먼저 지워 삭제 중인 항목이 적중되지 않도록 함
+        for ext in (".json", ".pptx"):
+            try:
+                os.remove(os.path.join(cache_dir, key + ext))
+            except OSError:
+                pass
+        total -= size
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
 
 
+def run_conversion(job_id, sources, file_type, use_ai):
+    """
+    업로드 파일을 PPTX로 변환합니다.
+    전략: AI Vision을 항상 우선 사용 → 실패 시 PDF 직접 추출 → 최종 이미지 폴백
+
+    Args:
+        sources: 저장된 파일 경로 또는 메모리에 읽은 파일 바이트 목록
+
+    Returns:
+        dict: 변환 결과 (다운로드 URL, 사용한 방법, 슬라이드 수)
+    """
+    job_dir = os.path.join(app.config["UPLOAD_FOLDER"], job_id)
+    output_filename = f"NoteSlide_{job_id}.pptx"
+    output_path = os.path.join(job_dir, output_filename)
+
+    method_used = "unknown"
+    slide_count = len(sources)
+    failed_slides = 0  # AI 분석에 실패한 슬라이드 수 (하나라도 있으면 결과 캐시 안 함)
+
+    def result(method, count):
+        return {
+            "success": True,
+            "job_id": job_id,
+            "filename": output_filename,
+            "method": method,
+            "slide_count": count,
+            "download_url": f"/api/download/{job_id}/{output_filename}",
+        }
+
+    # 같은 파일을 다시 올리면 이전 결과 재사용
+    cache_key = result_cache_key(sources, use_ai)
+    cached = load_cached_result(cache_key, output_path)
+    if cached is not None:
+        log(f"[{job_id}] 결과 캐시 적중 → 변환 생략 (방법: {cached['method']})")
+        return result(cached["method"], cached["slide_count"])
+
+    if file_type == "pdf":
+        pdf_path = sources[0]
+
+        # 전략 1: PDF에서 직접 텍스트/이미지 추출 (빠름, 타임아웃 안전)
+        log(f"[{job_id}] PDF 직접 추출 시도...")
+        slides_data = extract_from_pdf(pdf_path)
+        slide_count = len(slides_data)
+        has_text = any(s.has_sufficient_text for s in slides_data)
+        total_text_blocks = sum(len(s.text_blocks) for s in slides_data)
+        log(f"[{job_id}] 직접 추출 결과: {len(slides_data)}페이지, {total_text_blocks}개 텍스트 블록, 충분: {has_text}")
+
+        if has_text:
+            # 텍스트가 충분하면 직접 추출로 PPTX 생성
+            build_pptx_from_pdf_data(slides_data, output_path)
+            method_used = "direct_extraction"
+            log(f"[{job_id}] PDF 직접 추출로 PPTX 생성 완료")
+        elif use_ai:
+            # 텍스트가 부족할 때만 AI Vision 사용
+            log(f"[{job_id}] 텍스트 부족 → AI Vision 분석 시작...")
+            try:
+                # 페이지를 렌더링하는 대로 분석기로 흘려보냄
+                layouts = analyze_slides_grouped(iter_page_images(pdf_path))
+                total_elements = sum(len(l.elements) for l in layouts)
+                failed_slides = sum(1 for l in layouts if l.failed)
+                log(f"[{job_id}] AI Vision 결과: {total_elements}개 요소 인식, 실패 {failed_slides}개 슬라이드")
+
+                if total_elements > 0:
+                    # 이미지 요소가 있는 페이지만 필요할 때 다시 렌더링 (최근 2장만 유지)
+                    pages = PageAccessor.for_pdf(pdf_path, dpi=PAGE_RENDER_DPI)
+                    build_pptx_from_ai_data(layouts, pages, output_path)
+                    method_used = "ai_vision"
+                    log(f"[{job_id}] AI Vision으로 PPTX 생성 완료")
+                else:
+                    raise ValueError("AI Vision이 요소를 인식하지 못했습니다")
+            except Exception as ai_err:
+                log(f"[{job_id}] AI Vision 실패: {ai_err}")
+                # 최종 폴백: 이미지 배경
+                build_pptx_with_background_images(iter_page_images(pdf_path), output_path)
+                method_used = "image_fallback"
+                log(f"[{job_id}] 이미지 폴백으로 PPTX 생성 완료")
+        else:
+            # API 키 없음: PDF 직접 추출 시도
+            log(f"[{job_id}] API 키 없음, PDF 직접 추출 시도...")
+            slides_data = extract_from_pdf(pdf_path)
+            has_text = any(s.has_sufficient_text for s in slides_data)
+            if has_text:
+                build_pptx_from_pdf_data(slides_data, output_path)
+                method_used = "direct_extraction"
+            else:
+                build_pptx_with_background_images(iter_page_images(pdf_path), output_path)
+                method_used = "image_fallback"
+            log(f"[{job_id}] 방법: {method_used}")
+
+    elif file_type == "images":
+        log(f"[{job_id}] 이미지 파일 처리 시작...")
+        # 전체 이미지를 들고 있지 않고 단계마다 원본에서 한 장씩 다시 읽음
+        slide_count = len(sources)
+
+        if use_ai:
+            log(f"[{job_id}] AI Vision 분석 시작...")
+            try:
+                layouts = analyze_slides_grouped(iter_images(sources))
+                total_elements = sum(len(l.elements) for l in layouts)
+                failed_slides = sum(1 for l in layouts if l.failed)
+                log(f"[{job_id}] AI Vision 결과: {total_elements}개 요소 인식, 실패 {failed_slides}개 슬라이드")
+
+                if total_elements > 0:
+                    pages = PageAccessor.for_images(sources)
+                    build_pptx_from_ai_data(layouts, pages, output_path)
+                    method_used = "ai_vision"
+                else:
+                    raise ValueError("AI Vision이 요소를 인식하지 못했습니다")
+            except Exception as ai_err:
+                log(f"[{job_id}] AI Vision 실패: {ai_err}")
+                build_pptx_with_background_images(iter_images(sources), output_path)
+                method_used = "image_fallback"
+        else:
+            build_pptx_with_background_images(iter_images(sources), output_path)
+            method_used = "image_fallback"
+
+        log(f"[{job_id}] 방법: {method_used}")
+
+    log(f"[{job_id}] === 변환 완료 === 방법: {method_used}")
+
+    # AI를 쓸 수 있었는데 이미지 폴백이 되었거나 일부 슬라이드 분석이 실패한 경우는
+    # 일시적 실패(429, 빈 응답 등)일 수 있으므로 캐시하지 않음
+    if failed_slides:
+        log(f"[{job_id}] 실패한 슬라이드가 있어 결과를 캐시하지 않음")
+    elif not (use_ai and method_used == "image_fallback"):
+        store_cached_result(cache_key, output_path, {
+            "method": method_used,
+            "slide_count": slide_count,
+        })
+
+    return result(method_used, slide_count)
+
+
+if celery_app is not None:
+    @celery_app.task(name="noteslide.convert")
+    def run_convert(job_id, saved_files, file_type, use_ai):
+        """Celery 워커에서 변환 실행 (실패 시 작업 디렉토리 정리)"""
+        try:
+            return run_conversion(job_id, saved_files, file_type, use_ai)
+        except Exception as e:
+            log(f"[{job_id}] !!! 변환 오류: {e}")
+            traceback.print_exc()
+            shutil.rmtree(os.path.join(app.config["UPLOAD_FOLDER"], job_id), ignore_errors=True)
+            raise
+
+
 @app.route("/api/convert", methods=["POST"])
 def convert():
     """
     파일 업로드 및 변환 API
-    전략: AI Vision을 항상 우선 사용 → 실패 시 PDF 직접 추출 → 최종 이미지 폴백
+    REDIS_URL이 설정되어 있으면 Celery 워커에 작업을 넘기고 상태 조회 URL을 반환,
+    아니면 요청 안에서 바로 변환합니다.
     """
     ensure_upload_dir()
 
@@ -85,6 +343,13 @@ def convert():
         saved_files = []
         file_type = None  # "pdf" or "images"
 
+        # 워커가 파일을 읽어야 하는 Celery 경로가 아니고 요청이 작으면 디스크 저장 생략
+        keep_in_memory = (
+            celery_app is None
+            and request.content_length is not None
+            and request.content_length < IN_MEMORY_UPLOAD_LIMIT
+        )
+
         for f in files:
             if not allowed_file(f.filename):
                 return jsonify({
@@ -96,9 +361,12 @@ def convert():
                 ext = f.filename.rsplit(".", 1)[1].lower() if "." in f.filename else "bin"
                 filename = f"{job_id}_{len(saved_files)}.{ext}"
 
-            filepath = os.path.join(job_dir, filename)
-            f.save(filepath)
-            saved_files.append(filepath)
+            if keep_in_memory:
+                saved_files.append(f.stream.read())
+            else:
+                filepath = os.path.join(job_dir, filename)
+                f.save(filepath)
+                saved_files.append(filepath)
 
             ext = filename.rsplit(".", 1)[1].lower()
             if ext == "pdf":
@@ -106,102 +374,20 @@ def convert():
             elif file_type != "pdf":
                 file_type = "images"
 
-        log(f"[{job_id}] 파일 타입: {file_type}, 파일 수: {len(saved_files)}")
-
-        # --- 변환 처리 ---
-        output_filename = f"NoteSlide_{job_id}.pptx"
-        output_path = os.path.join(job_dir, output_filename)
+        log(f"[{job_id}] 파일 타입: {file_type}, 파일 수: {len(saved_files)}, 메모리 처리: {keep_in_memory}")
 
         use_ai = os.environ.get("GEMINI_API_KEY", "").strip() != ""
-        method_used = "unknown"
 
-        if file_type == "pdf":
-            pdf_path = saved_files[0]
+        if celery_app is not None:
+            task = run_convert.delay(job_id, saved_files, file_type, use_ai)
+            log(f"[{job_id}] 워커에 작업 등록: {task.id}")
+            return jsonify({
+                "success": True,
+                "job_id": job_id,
+                "status_url": f"/api/status/{task.id}",
+            }), 202
 
-            # 전략 1: PDF에서 직접 텍스트/이미지 추출 (빠름, 타임아웃 안전)
-            log(f"[{job_id}] PDF 직접 추출 시도...")
-            slides_data = extract_from_pdf(pdf_path)
-            has_text = any(s.has_sufficient_text for s in slides_data)
-            total_text_blocks = sum(len(s.text_blocks) for s in slides_data)
-            log(f"[{job_id}] 직접 추출 결과: {len(slides_data)}페이지, {total_text_blocks}개 텍스트 블록, 충분: {has_text}")
-
-            if has_text:
-                # 텍스트가 충분하면 직접 추출로 PPTX 생성
-                build_pptx_from_pdf_data(slides_data, output_path)
-                method_used = "direct_extraction"
-                log(f"[{job_id}] PDF 직접 추출로 PPTX 생성 완료")
-            elif use_ai:
-                # 텍스트가 부족할 때만 AI Vision 사용
-                log(f"[{job_id}] 텍스트 부족 → AI Vision 분석 시작...")
-                page_images = pdf_pages_to_images(pdf_path, dpi=200)
-                log(f"[{job_id}] {len(page_images)}개 페이지 이미지 생성 완료")
-                try:
-                    layouts = analyze_slides_batch(page_images)
-                    total_elements = sum(len(l.elements) for l in layouts)
-                    log(f"[{job_id}] AI Vision 결과: {total_elements}개 요소 인식")
-
-                    if total_elements > 0:
-                        build_pptx_from_ai_data(layouts, page_images, output_path)
-                        method_used = "ai_vision"
-                        log(f"[{job_id}] AI Vision으로 PPTX 생성 완료")
-                    else:
-                        raise ValueError("AI Vision이 요소를 인식하지 못했습니다")
-                except Exception as ai_err:
-                    log(f"[{job_id}] AI Vision 실패: {ai_err}")
-                    # 최종 폴백: 이미지 배경
-                    build_pptx_with_background_images(page_images, output_path)
-                    method_used = "image_fallback"
-                    log(f"[{job_id}] 이미지 폴백으로 PPTX 생성 완료")
-            else:
-                # API 키 없음: PDF 직접 추출 시도
-                log(f"[{job_id}] API 키 없음, PDF 직접 추출 시도...")
-                slides_data = extract_from_pdf(pdf_path)
-                has_text = any(s.has_sufficient_text for s in slides_data)
-                if has_text:
-                    build_pptx_from_pdf_data(slides_data, output_path)
-                    method_used = "direct_extraction"
-                else:
-                    build_pptx_with_background_images(page_images, output_path)
-                    method_used = "image_fallback"
-                log(f"[{job_id}] 방법: {method_used}")
-
-        elif file_type == "images":
-            log(f"[{job_id}] 이미지 파일 처리 시작...")
-            slides_data = images_to_slide_data(saved_files)
-            page_images = [s.page_image for s in slides_data]
-
-            if use_ai:
-                log(f"[{job_id}] AI Vision 분석 시작...")
-                try:
-                    layouts = analyze_slides_batch(page_images)
-                    total_elements = sum(len(l.elements) for l in layouts)
-                    log(f"[{job_id}] AI Vision 결과: {total_elements}개 요소 인식")
-
-                    if total_elements > 0:
-                        build_pptx_from_ai_data(layouts, page_images, output_path)
-                        method_used = "ai_vision"
-                    else:
-                        raise ValueError("AI Vision이 요소를 인식하지 못했습니다")
-                except Exception as ai_err:
-                    log(f"[{job_id}] AI Vision 실패: {ai_err}")
-                    build_pptx_with_background_images(page_images, output_path)
-                    method_used = "image_fallback"
-            else:
-                build_pptx_with_background_images(page_images, output_path)
-                method_used = "image_fallback"
-
-            log(f"[{job_id}] 방법: {method_used}")
-
-        log(f"[{job_id}] === 변환 완료 === 방법: {method_used}")
-
-        return jsonify({
-            "success": True,
-            "job_id": job_id,
-            "filename": output_filename,
-            "method": method_used,
-            "slide_count": len(page_images) if 'page_images' in dir() else len(saved_files),
-            "download_url": f"/api/download/{job_id}/{output_filename}",
-        })
+        return jsonify(run_conversion(job_id, saved_files, file_type, use_ai))
 
     except Exception as e:
         log(f"[{job_id}] !!! 변환 오류: {e}")
@@ -211,6 +397,23 @@ def convert():
         return jsonify({"error": f"변환 중 오류가 발생했습니다: {str(e)}"}), 500
 
 
+@app.route("/api/status/<task_id>")
+def status(task_id):
+    """Celery 변환 작업 상태 조회"""
+    if celery_app is None:
+        return jsonify({"error": "비동기 작업 큐가 설정되지 않았습니다."}), 404
+
+    task = celery_app.AsyncResult(task_id)
+    payload = {"task_id": task_id, "status": task.state}
+    if task.state == "SUCCESS":
+        payload["result"] = task.result
+    elif task.state == "FAILURE":
+        payload["error"] = f"변환 중 오류가 발생했습니다: {task.info}"
+    elif isinstance(task.info, dict):
+        payload["info"] = task.info
+    return jsonify(payload)
+
+
 @app.route("/api/download/<job_id>/<filename>")
 def download(job_id, filename):
     """변환된 PPTX 파일 다운로드"""
@@ -6,12 +6,47 @@ AI 분석 모듈
 
 import google.generativeai as genai
 from PIL import Image
+import hashlib
+import io
 import json
+import orjson
 import os
 import re
 import sys
+import threading
+import time
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dataclasses import dataclass, field
 
+# 동시 Gemini 호출 수 (I/O 바운드이므로 스레드로 충분)
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "8"))
+
+# 한 번의 Gemini 요청에 함께 보낼 슬라이드 수
+SLIDES_PER_REQUEST = int(os.environ.get("GEMINI_SLIDES_PER_REQUEST", "3"))
+
+# 사용할 Gemini 모델
+GEMINI_MODEL = "gemini-2.0-flash"
+
+# Vision 입력 최대 변 길이 (px) — 레이아웃/OCR 인식에 충분한 크기
+VISION_BUDGET_PX = 1280
+VISION_JPEG_QUALITY = 85
+
+# Vision 입력 리사이즈 필터 — 레이아웃 인식에는 LANCZOS와 차이가 없고 2-3배 빠름
+VISION_RESAMPLE = Image.BICUBIC
+
+# 프롬프트/파싱 방식을 바꾸면 올려서 기존 캐시를 무효화
+PROMPT_VERSION = "v2"
+
+# 분석 결과 캐시 디렉토리 (이미지 해시 → JSON)
+LAYOUT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "uploads", ".layout_cache",
+)
+LAYOUT_CACHE_MAX_AGE = 30 * 24 * 3600  # 30일 동안 사용되지 않은 항목은 삭제
+LAYOUT_CACHE_MAX_BYTES = 100 * 1024 * 1024  # 총 100MB 초과 시 가장 오래 안 쓴 것부터 삭제
+LAYOUT_CACHE_PRUNE_INTERVAL = 600  # 디렉토리 전체를 훑는 정리는 10분에 한 번까지만
+
 
 @dataclass
 class SlideElement:
@@ -37,6 +72,7 @@ class SlideLayout:
     background_color: str = "#FFFFFF"
     slide_width: float = 960
     slide_height: float = 540
+    failed: bool = False  # 분석 실패로 비어 있는 레이아웃 (빈 응답, 파싱 실패, API 오류)
 
 
 def _log(msg):
@@ -96,78 +132,146 @@ CRITICAL RULES:
 - For text alignment: use "center" for centered text, "left" for left-aligned, "right" for right-aligned
 - Include ALL shapes/boxes/containers as "shape" elements with their background colors
 - Order elements: shapes first (background layer), then text (foreground), then images
+- If several slide images are given (labelled "Slide 1:", "Slide 2:", ...), return a JSON array with one object of the structure above per slide, in input order
 - Return ONLY valid JSON, nothing else - no markdown, no explanation"""
 
+# 여러 슬라이드를 한 요청에 보낼 때 마지막에 붙이는 지시문
+GROUP_INSTRUCTION = "Analyze each of the {count} slides above. Return a JSON array of {count} slide objects in input order."
+
+
+_configured_key = None
+
 
 def _configure_api():
-    """Gemini API 설정"""
+    """Gemini API 설정 (같은 키로는 한 번만 configure)"""
+    global _configured_key
     api_key = os.environ.get("GEMINI_API_KEY", "").strip()
     if not api_key:
         raise ValueError(
             "GEMINI_API_KEY 환경변수가 설정되지 않았습니다. "
             ".env 파일에 API 키를 설정해주세요."
         )
-    genai.configure(api_key=api_key)
+    if api_key != _configured_key:
+        genai.configure(api_key=api_key)
+        _configured_key = api_key
     return api_key
 
 
-def analyze_slide(image: Image.Image, slide_num: int = 0) -> SlideLayout:
-    """
-    슬라이드 이미지를 AI Vision으로 분석하여 구조화된 레이아웃을 반환합니다.
-    """
-    api_key = _configure_api()
-    _log(f"슬라이드 {slide_num} 분석 시작 (이미지 크기: {image.size})")
+def _get_model():
+    """분석용 GenerativeModel 반환 (ANALYSIS_PROMPT는 system_instruction으로 전달)"""
+    return genai.GenerativeModel(GEMINI_MODEL, system_instruction=ANALYSIS_PROMPT)
 
-    model = genai.GenerativeModel("gemini-2.0-flash")
 
-    # 이미지 크기 제한 (API 비용 절약 + 빠른 응답)
-    max_dim = 1920
-    if max(image.size) > max_dim:
-        ratio = max_dim / max(image.size)
-        new_size = (int(image.width * ratio), int(image.height * ratio))
-        image = image.resize(new_size, Image.LANCZOS)
-        _log(f"  이미지 리사이즈: {new_size}")
+def _cache_key(image: Image.Image) -> str:
+    """이미지 픽셀 + 프롬프트 버전으로 캐시 키 생성"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    h.update(image.tobytes())
+    h.update(PROMPT_VERSION.encode())
+    return h.hexdigest()
 
-    response = model.generate_content(
-        [ANALYSIS_PROMPT, image],
-        generation_config=genai.types.GenerationConfig(
-            temperature=0.1,
-            max_output_tokens=8192,
-        ),
-    )
 
-    # 응답 확인
-    if not response or not response.text:
-        _log(f"  경고: 빈 응답 수신")
-        return SlideLayout()
+def _cache_path(key: str) -> str:
+    # 앞 2글자로 샤딩하여 디렉토리당 파일 수 제한
+    return os.path.join(LAYOUT_CACHE_DIR, key[:2], f"{key}.json")
 
-    response_text = response.text.strip()
-    _log(f"  응답 길이: {len(response_text)} 글자")
 
-    # JSON 파싱
-    # 코드 블록 마커 제거
-    if response_text.startswith("```"):
-        response_text = re.sub(r"^```(?:json)?\s*\n?", "", response_text)
-        response_text = re.sub(r"\n?\s*```$", "", response_text)
+def _cache_get(key: str):
+    """캐시된 분석 JSON 반환 (없으면 None)"""
+    path = _cache_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # 적중 시각을 기록하여 정리 시 최근에 쓴 항목을 남김 (LRU)
+        os.utime(path)
+        return data
+    except (OSError, ValueError):
+        return None
+
 
+def _cache_set(key: str, data: dict):
+    """분석 JSON을 캐시에 저장 (임시 파일 → rename으로 원자적 기록)"""
+    path = _cache_path(key)
     try:
-        data = json.loads(response_text)
-    except json.JSONDecodeError as e:
-        _log(f"  JSON 파싱 실패 (1차): {e}")
-        # JSON 부분만 추출 시도
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
-        if json_match:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _log(f"  캐시 저장 실패: {e}")
+
+
+_last_layout_prune = 0.0
+_layout_prune_lock = threading.Lock()
+
+
+def _prune_layout_cache():
+    """오래 사용되지 않았거나 총 용량을 넘는 분석 캐시 항목 삭제 (마지막 사용이 오래된 것부터)"""
+    global _last_layout_prune
+    with _layout_prune_lock:
+        if time.monotonic() - _last_layout_prune < LAYOUT_CACHE_PRUNE_INTERVAL:
+            return
+        _last_layout_prune = time.monotonic()
+
+    entries = []
+    try:
+        shards = os.listdir(LAYOUT_CACHE_DIR)
+    except OSError:
+        return
+    for shard in shards:
+        shard_dir = os.path.join(LAYOUT_CACHE_DIR, shard)
+        try:
+            names = os.listdir(shard_dir)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(shard_dir, name)
             try:
-                data = json.loads(json_match.group())
-                _log(f"  JSON 추출 성공 (2차)")
-            except json.JSONDecodeError:
-                _log(f"  JSON 파싱 완전 실패. 응답 앞부분: {response_text[:200]}")
-                return SlideLayout()
-        else:
-            _log(f"  JSON 패턴 없음. 응답 앞부분: {response_text[:200]}")
-            return SlideLayout()
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if now - mtime <= LAYOUT_CACHE_MAX_AGE and total <= LAYOUT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    if removed:
+        _log(f"분석 캐시 정리: {removed}개 항목 삭제")
 
-    # SlideLayout 구성
+
+# 분석 JSON 구조/타입이 잘못되었을 때 _layout_from_dict가 내는 예외
+_LAYOUT_ERRORS = (TypeError, ValueError, AttributeError)
+
+
+def _cached_layout(key: str):
+    """캐시된 레이아웃 반환 (없거나 형식이 잘못된 항목이면 None)"""
+    cached = _cache_get(key)
+    if cached is None:
+        return None
+    try:
+        layout = _layout_from_dict(cached)
+    except _LAYOUT_ERRORS as e:
+        _log(f"  잘못된 캐시 항목 무시: {key} ({e})")
+        return None
+    _log(f"  캐시 적중: {key}")
+    return layout
+
+
+def _layout_from_dict(data: dict) -> SlideLayout:
+    """분석 JSON(dict)을 SlideLayout으로 변환 (형식이 잘못되면 _LAYOUT_ERRORS 예외)"""
+    if not isinstance(data, dict):
+        raise ValueError(f"슬라이드 JSON이 객체가 아닙니다: {type(data).__name__}")
     layout = SlideLayout(
         background_color=data.get("background_color", "#FFFFFF"),
     )
@@ -204,23 +308,310 @@ def analyze_slide(image: Image.Image, slide_num: int = 0) -> SlideLayout:
     return layout
 
 
-def analyze_slides_batch(images: list) -> list:
+def _prepare_image(image: Image.Image) -> Image.Image:
+    """Vision 입력 크기로 줄이고 RGB로 변환"""
+    # 이미지 크기 제한 (API 비용 절약 + 빠른 응답)
+    max_dim = VISION_BUDGET_PX
+    if max(image.size) > max_dim:
+        ratio = max_dim / max(image.size)
+        new_size = (int(image.width * ratio), int(image.height * ratio))
+        image = image.resize(new_size, VISION_RESAMPLE)
+        _log(f"  이미지 리사이즈: {new_size}")
+    if image.mode != "RGB":
+        image = image.convert("RGB")  # 알파 채널 제거
+    return image
+
+
+def _encode_image(image: Image.Image) -> dict:
+    """
+    PIL 이미지를 그대로 넘기면 PNG로 직렬화되므로 JPEG로 직접 인코딩
+    (ICC 프로파일 등 메타데이터는 포함하지 않음)
+    """
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=VISION_JPEG_QUALITY)
+    image_part = {"mime_type": "image/jpeg", "data": buf.getvalue()}
+    _log(f"  전송 크기: {len(image_part['data']) // 1024} KB")
+    return image_part
+
+
+def _generate(parts: list):
+    """Gemini 호출 후 코드 블록 마커를 제거한 응답 텍스트 반환 (빈 응답이면 None)"""
+    model = _get_model()
+    response = model.generate_content(
+        parts,
+        generation_config=genai.types.GenerationConfig(
+            temperature=0.1,
+            max_output_tokens=8192,
+        ),
+    )
+
+    # 출력 토큰 한도에 걸리면 응답이 중간에 잘림 (묶음 요청에서 완성된 항목만 사용)
+    if response and response.candidates and \
+            response.candidates[0].finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+        _log(f"  경고: 출력 토큰 한도로 응답이 잘림")
+
+    # 응답 확인
+    if not response or not response.text:
+        _log(f"  경고: 빈 응답 수신")
+        return None
+
+    response_text = response.text.strip()
+    _log(f"  응답 길이: {len(response_text)} 글자")
+
+    # 코드 블록 마커 제거
+    if response_text.startswith("```"):
+        response_text = re.sub(r"^```(?:json)?\s*\n?", "", response_text)
+        response_text = re.sub(r"\n?\s*```$", "", response_text)
+    return response_text
+
+
+def _extract_json(text: str, opener: str = "{"):
+    """
+    text에서 opener로 시작하는 첫 JSON 값을 괄호 균형으로 찾아 잘라냅니다.
+    문자열 안의 괄호와 이스케이프를 건너뛰는 O(n) 전방 스캔 (정규식 백트래킹 없음)
+    """
+    start = text.find(opener)
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+def _complete_array_items(text: str) -> list:
+    """잘린 JSON 배열에서 끝까지 완성된 앞쪽 객체들만 파싱하여 반환"""
+    items = []
+    pos = text.find("[")
+    if pos < 0:
+        return items
+    while True:
+        pos = text.find("{", pos)
+        if pos < 0:
+            break
+        obj_text = _extract_json(text[pos:], "{")
+        if obj_text is None:
+            break
+        try:
+            items.append(orjson.loads(obj_text))
+        except orjson.JSONDecodeError:
+            break
+        pos += len(obj_text)
+    return items
+
+
+def _parse_json(response_text: str, opener: str = "{"):
+    """응답 텍스트를 JSON으로 파싱 (실패 시 opener로 시작하는 부분만 재시도, 그래도 실패하면 None)"""
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
+        _log(f"  JSON 파싱 실패 (1차): {e}")
+        # JSON 부분만 추출 시도
+        json_text = _extract_json(response_text, opener)
+        if json_text:
+            try:
+                data = orjson.loads(json_text)
+                _log(f"  JSON 추출 성공 (2차)")
+                return data
+            except orjson.JSONDecodeError:
+                _log(f"  JSON 파싱 완전 실패. 응답 앞부분: {response_text[:200]}")
+                return None
+        else:
+            _log(f"  JSON 패턴 없음. 응답 앞부분: {response_text[:200]}")
+            return None
+
+
+def analyze_slide(image: Image.Image, slide_num: int = 0) -> SlideLayout:
+    """
+    슬라이드 이미지를 AI Vision으로 분석하여 구조화된 레이아웃을 반환합니다.
+    """
+    api_key = _configure_api()
+    _log(f"슬라이드 {slide_num} 분석 시작 (이미지 크기: {image.size})")
+
+    image = _prepare_image(image)
+
+    # 동일 이미지는 캐시된 결과 재사용 (API 호출 생략)
+    cache_key = _cache_key(image)
+    cached = _cached_layout(cache_key)
+    if cached is not None:
+        return cached
+
+    response_text = _generate([_encode_image(image)])
+    if response_text is None:
+        return SlideLayout(failed=True)
+
+    data = _parse_json(response_text)
+    if data is None:
+        return SlideLayout(failed=True)
+
+    # 변환에 성공한 응답만 다음 동일 이미지 요청을 위해 캐시
+    layout = _layout_from_dict(data)
+    _cache_set(cache_key, data)
+    return layout
+
+
+def _retry_slide(image: Image.Image, slide_num: int) -> SlideLayout:
+    """묶음에서 빠진 슬라이드를 단독 분석 (실패해도 같은 묶음의 다른 슬라이드에 영향 없음)"""
+    try:
+        return analyze_slide(image, slide_num=slide_num)
+    except Exception as e:
+        _log(f"슬라이드 {slide_num} 분석 실패: {e}")
+        import traceback
+        traceback.print_exc()
+        return SlideLayout(failed=True)
+
+
+def _analyze_group(images: list, first_num: int) -> list:
     """
-    여러 슬라이드 이미지를 배치로 분석합니다.
+    여러 슬라이드를 한 번의 요청으로 분석합니다.
+    응답 배열이 슬라이드 수와 맞지 않거나 항목이 잘못된 슬라이드는 단일 분석으로 재시도합니다.
     """
-    _log(f"배치 분석 시작: {len(images)}개 슬라이드")
-    layouts = []
-    for i, img in enumerate(images):
+    if len(images) == 1:
+        return [analyze_slide(images[0], slide_num=first_num)]
+
+    last_num = first_num + len(images) - 1
+    _log(f"슬라이드 {first_num}-{last_num} 묶음 분석 시작")
+
+    prepared = [_prepare_image(img) for img in images]
+    keys = [_cache_key(img) for img in prepared]
+    layouts = [None] * len(prepared)
+
+    # 캐시에 없는 슬라이드만 요청
+    todo = []
+    for j, key in enumerate(keys):
+        layouts[j] = _cached_layout(key)
+        if layouts[j] is None:
+            todo.append(j)
+
+    if len(todo) == 1:
+        j = todo[0]
+        layouts[j] = _retry_slide(prepared[j], first_num + j)
+    elif todo:
+        parts = []
+        for k, j in enumerate(todo):
+            parts += [f"Slide {k + 1}:", _encode_image(prepared[j])]
+        parts.append(GROUP_INSTRUCTION.format(count=len(todo)))
+
         try:
-            layout = analyze_slide(img, slide_num=i + 1)
-            layouts.append(layout)
-            _log(f"슬라이드 {i+1}/{len(images)} 완료 ({len(layout.elements)}개 요소)")
+            response_text = _generate(parts)
         except Exception as e:
-            _log(f"슬라이드 {i+1} 분석 실패: {e}")
-            import traceback
-            traceback.print_exc()
-            layouts.append(SlideLayout())
-    
+            # 429/타임아웃 등 묶음 요청 자체가 실패해도 슬라이드별로 다시 시도
+            _log(f"  묶음 요청 실패: {e} → 슬라이드별 분석으로 재시도")
+            items = None
+        else:
+            data = _parse_json(response_text, "[") if response_text else None
+            if isinstance(data, list):
+                items = data if len(data) == len(todo) else None
+            else:
+                # 잘린 응답이면 완성된 앞쪽 슬라이드만 사용하고 나머지만 다시 요청
+                items = _complete_array_items(response_text) if response_text else []
+                if items:
+                    _log(f"  묶음 응답 중 {len(items)}/{len(todo)}장만 완성 → 나머지는 슬라이드별 분석")
+                else:
+                    items = None
+            if items is None:
+                _log(f"  묶음 응답 형식 불일치 → 슬라이드별 분석으로 재시도")
+
+        for k, j in enumerate(todo):
+            item = items[k] if items is not None and k < len(items) else None
+            if item is not None:
+                try:
+                    layouts[j] = _layout_from_dict(item)
+                    _cache_set(keys[j], item)
+                    continue
+                except _LAYOUT_ERRORS as e:
+                    _log(f"  슬라이드 {first_num + j} 응답 형식 오류: {e}")
+            layouts[j] = _retry_slide(prepared[j], first_num + j)
+
+    return layouts
+
+
+def analyze_slides_grouped(images, group: int = SLIDES_PER_REQUEST) -> list:
+    """
+    여러 슬라이드 이미지를 group장씩 묶어 분석합니다.
+    묶음마다 스레드 풀에서 병렬로 요청하여 네트워크 대기 시간을 겹칩니다.
+
+    Args:
+        images: PIL Image 목록 또는 이터러블 (예: iter_pdf_pages의 이미지 제너레이터).
+            이터러블이면 동시 요청 수보다 조금 많은 묶음까지만 미리 읽어 메모리 사용을 제한합니다.
+        group: 한 요청에 함께 보낼 슬라이드 수 (1이면 슬라이드별 요청)
+    """
+    total_count = len(images) if hasattr(images, "__len__") else None
+    total_label = total_count if total_count is not None else "?"
+    group = max(1, group)
+    _log(f"배치 분석 시작: {total_label}개 슬라이드 (동시 요청: {GEMINI_CONCURRENCY}, 요청당 {group}장)")
+    if total_count == 0:
+        return []
+
+    # 스레드마다 genai.configure가 몰리지 않도록 한 번만 설정
+    _configure_api()
+
+    max_workers = max(1, GEMINI_CONCURRENCY)
+    # 모든 워커가 요청 중일 때도 다음 묶음이 대기하도록 창을 워커 수보다 조금 크게
+    # (추가 분량은 페이지 기준 약 동시 요청 수만큼)
+    prefetch = max_workers + max(1, max_workers // group)
+    results = {}
+    pending = {}
+
+    def _collect(done):
+        for future in done:
+            start, count = pending.pop(future)
+            try:
+                layouts = future.result()
+            except Exception as e:
+                _log(f"슬라이드 {start+1}-{start+count} 분석 실패: {e}")
+                import traceback
+                traceback.print_exc()
+                layouts = [SlideLayout(failed=True) for _ in range(count)]
+            for k, layout in enumerate(layouts):
+                results[start + k] = layout
+                _log(f"슬라이드 {start+k+1}/{total_label} 완료 ({len(layout.elements)}개 요소)")
+
+    it = iter(images)
+    start = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            chunk = list(islice(it, group))
+            if not chunk:
+                break
+            # 진행 중인 작업이 창 크기를 넘으면 하나 이상 끝날 때까지 대기
+            if len(pending) >= prefetch:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done)
+            pending[executor.submit(_analyze_group, chunk, start + 1)] = (start, len(chunk))
+            start += len(chunk)
+            chunk = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            _collect(done)
+
+    layouts = [results[i] for i in range(len(results))]
     total = sum(len(l.elements) for l in layouts)
-    _log(f"배치 분석 완료: 총 {total}개 요소 인식")
+    failed = sum(1 for l in layouts if l.failed)
+    _log(f"배치 분석 완료: 총 {total}개 요소 인식, 실패 {failed}개 슬라이드")
+    _prune_layout_cache()
     return layouts
+
+
+def analyze_slides_batch(images) -> list:
+    """
+    여러 슬라이드 이미지를 슬라이드별 요청으로 병렬 분석합니다.
+    """
+    return analyze_slides_grouped(images, group=1)
@@ -9,11 +9,32 @@ from PIL import Image
 import io
 import os
 import gc
+import functools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
 
 # 이미지 최대 크기 (메모리 절약)
 MAX_IMAGE_DIM = 1200
 
+# 업로드 이미지 디코딩 목표 크기 (JPEG는 이 크기 이상으로만 축소 디코딩)
+UPLOAD_DRAFT_DIM = 1600
+
+# 페이지 렌더링 옵션: 알파 채널 없이 RGB(3바이트/픽셀), 주석 합성 생략
+PIXMAP_OPTIONS = {"alpha": False, "annots": False, "colorspace": fitz.csRGB}
+
+# 이 페이지 수 미만이면 프로세스 풀 없이 직렬 렌더링
+PARALLEL_RENDER_MIN_PAGES = 4
+
+# 렌더링 프로세스 최대 수 (사용 가능한 CPU 수와 중 작은 값, 1이면 항상 직렬)
+PDF_RENDER_WORKERS = int(os.environ.get("PDF_RENDER_WORKERS", "4"))
+
+# 프로세스 풀 작업 하나가 렌더링하는 연속 페이지 수
+RENDER_CHUNK_PAGES = 2
+
 
 @dataclass
 class TextBlock:
@@ -58,27 +79,73 @@ class SlideData:
         return total_chars > 20  # 최소 20자 이상이면 충분
 
 
+# 0-255 → 두 자리 hex 문자열 조회 테이블
+_HEX = [f"{i:02x}" for i in range(256)]
+
+
 def _hex_color(color_int):
     """PyMuPDF 색상값을 hex로 변환"""
     if isinstance(color_int, int):
-        r = (color_int >> 16) & 0xFF
-        g = (color_int >> 8) & 0xFF
-        b = color_int & 0xFF
-        return f"#{r:02x}{g:02x}{b:02x}"
+        return "#" + _HEX[(color_int >> 16) & 0xFF] + _HEX[(color_int >> 8) & 0xFF] + _HEX[color_int & 0xFF]
     return "#000000"
 
 
-def extract_from_pdf(pdf_path: str) -> list:
+def _open_pdf(pdf_source):
+    """파일 경로 또는 메모리의 PDF 바이트로 문서 열기"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+
+def _extract_text_blocks(page) -> list:
+    """
+    페이지의 텍스트 span을 TextBlock 목록으로 변환합니다.
+    페이지당 span 수백 개를 도는 핫 루프이므로 전역/속성 조회를 지역 변수로 올리고
+    텍스트 블록 외에는 키 조회를 하지 않습니다.
+    """
+    text_dict = page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+    blocks = []
+    append = blocks.append
+    hex_color = _hex_color
+    make_block = TextBlock
+
+    for block in text_dict["blocks"]:
+        if block["type"] != 0:  # 텍스트 블록만
+            continue
+        for line in block["lines"]:
+            for span in line["spans"]:
+                text = span["text"].strip()
+                if not text:
+                    continue
+
+                x0, y0, x1, y1 = span["bbox"]
+                font_flags = span["flags"]
+                append(make_block(
+                    text,
+                    x0,
+                    y0,
+                    x1 - x0,
+                    y1 - y0,
+                    span["size"],
+                    span["font"],
+                    hex_color(span["color"]),
+                    bool(font_flags & 16),  # bold
+                    bool(font_flags & 2),  # italic
+                ))
+    return blocks
+
+
+def extract_from_pdf(pdf_path) -> list:
     """
     PDF에서 각 페이지의 텍스트/이미지를 추출합니다.
 
     Args:
-        pdf_path: PDF 파일 경로
+        pdf_path: PDF 파일 경로 또는 PDF 바이트
 
     Returns:
         list[SlideData]: 각 페이지의 추출 데이터
     """
-    doc = fitz.open(pdf_path)
+    doc = _open_pdf(pdf_path)
     slides = []
 
     for page_num in range(len(doc)):
@@ -91,32 +158,7 @@ def extract_from_pdf(pdf_path: str) -> list:
         )
 
         # --- 텍스트 블록 추출 ---
-        text_dict = page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)
-        for block in text_dict.get("blocks", []):
-            if block.get("type") == 0:  # 텍스트 블록
-                for line in block.get("lines", []):
-                    for span in line.get("spans", []):
-                        text = span.get("text", "").strip()
-                        if not text:
-                            continue
-
-                        bbox = span.get("bbox", (0, 0, 0, 0))
-                        font_flags = span.get("flags", 0)
-                        color_int = span.get("color", 0)
-
-                        tb = TextBlock(
-                            text=text,
-                            x=bbox[0],
-                            y=bbox[1],
-                            width=bbox[2] - bbox[0],
-                            height=bbox[3] - bbox[1],
-                            font_size=span.get("size", 12),
-                            font_name=span.get("font", ""),
-                            color=_hex_color(color_int),
-                            bold=bool(font_flags & 2**4),
-                            italic=bool(font_flags & 2**1),
-                        )
-                        slide.text_blocks.append(tb)
+        slide.text_blocks = _extract_text_blocks(page)
 
         # --- 이미지 추출 (메모리 최적화) ---
         image_list = page.get_images(full=True)
@@ -126,6 +168,8 @@ def extract_from_pdf(pdf_path: str) -> list:
                 base_image = doc.extract_image(xref)
                 image_bytes = base_image["image"]
                 pil_image = Image.open(io.BytesIO(image_bytes))
+                # JPEG는 디코딩 단계에서 축소 (DCT 스케일링, 다른 형식은 무시됨)
+                pil_image.draft("RGB", (MAX_IMAGE_DIM, MAX_IMAGE_DIM))
 
                 # 이미지 크기 제한
                 if max(pil_image.size) > MAX_IMAGE_DIM:
@@ -148,12 +192,15 @@ def extract_from_pdf(pdf_path: str) -> list:
                 continue
 
         # --- 배경색 추출 (간단한 방법) ---
-        # 페이지를 작은 이미지로 렌더링하여 모서리 색상 확인
+        # 페이지 전체 대신 좌상단 모서리 2x2pt 영역만 렌더링하여 평균 색상 사용
         try:
-            small_pix = page.get_pixmap(matrix=fitz.Matrix(0.1, 0.1))
-            small_img = Image.frombytes("RGB", [small_pix.width, small_pix.height], small_pix.samples)
-            corner_color = small_img.getpixel((0, 0))
-            slide.background_color = f"#{corner_color[0]:02x}{corner_color[1]:02x}{corner_color[2]:02x}"
+            corner_pix = page.get_pixmap(clip=fitz.Rect(0, 0, 2, 2), **PIXMAP_OPTIONS)
+            samples = corner_pix.samples
+            count = len(samples) // 3
+            r = sum(samples[0::3]) // count
+            g = sum(samples[1::3]) // count
+            b = sum(samples[2::3]) // count
+            slide.background_color = f"#{r:02x}{g:02x}{b:02x}"
         except Exception:
             pass
 
@@ -163,48 +210,171 @@ def extract_from_pdf(pdf_path: str) -> list:
     return slides
 
 
-def pdf_pages_to_images(pdf_path: str, dpi: int = 150) -> list:
+# 프로세스 풀은 처음 필요할 때 한 번 만들어 모든 요청이 공유 (요청마다 시작 비용을 내지 않음)
+_render_pool = None
+_render_pool_workers = 0
+_render_pool_lock = threading.Lock()
+
+
+def _available_cpus() -> int:
+    """이 프로세스가 실제로 쓸 수 있는 CPU 수 (affinity 제한 반영)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _get_render_pool():
+    """공유 렌더링 프로세스 풀 반환 (병렬 렌더링을 쓸 수 없으면 None)"""
+    global _render_pool, _render_pool_workers
+    workers = min(_available_cpus(), PDF_RENDER_WORKERS)
+    # 데몬 프로세스(Celery prefork 워커 등)는 자식 프로세스를 만들 수 없음
+    if workers < 2 or multiprocessing.current_process().daemon:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            # 요청 처리 스레드가 여럿인 서버 프로세스에서 fork하지 않도록 spawn 사용
+            _render_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _render_pool_workers = workers
+        return _render_pool
+
+
+def _discard_render_pool(pool):
+    """워커가 죽어 망가진 풀을 버려 다음 요청에서 새로 만들도록 함"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_page_range(pdf_path, start: int, stop: int, zoom: float) -> list:
     """
-    PDF의 각 페이지를 PIL Image로 변환합니다.
-    메모리 절약을 위해 DPI를 150으로 제한합니다.
+    워커 프로세스에서 start~stop-1 페이지를 렌더링합니다.
+    PIL Image 대신 (페이지 인덱스, 너비, 높이, RGB 바이트)를 반환하여 피클링 비용을 줄입니다.
     """
-    doc = fitz.open(pdf_path)
-    images = []
-    zoom = dpi / 72.0
     matrix = fitz.Matrix(zoom, zoom)
+    rendered = []
+    with _open_pdf(pdf_path) as doc:
+        for page_num in range(start, stop):
+            pix = doc[page_num].get_pixmap(matrix=matrix, **PIXMAP_OPTIONS)
+            rendered.append((page_num, pix.width, pix.height, pix.samples))
+            pix = None
+    return rendered
 
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        pix = page.get_pixmap(matrix=matrix)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        # pixmap 메모리 즉시 해제
-        pix = None
-        images.append(img)
 
-    doc.close()
+def iter_pdf_pages(pdf_path, dpi: int = 150):
+    """
+    PDF 페이지를 한 장씩 렌더링하여 (페이지 번호, PIL Image)를 yield합니다.
+    전체 목록을 메모리에 올리지 않으므로 소비자가 처리 후 바로 해제할 수 있습니다.
+    파일 경로이고 페이지가 많으면 공유 프로세스 풀에서 페이지 범위 단위로 미리 렌더링합니다.
+    """
+    zoom = dpi / 72.0
+    with _open_pdf(pdf_path) as doc:
+        page_count = len(doc)
+
+    done = 0
+    # 바이트 입력은 작업마다 파일 전체를 피클링해야 하므로 직렬 렌더링
+    pool = None
+    if isinstance(pdf_path, (str, os.PathLike)) and page_count >= PARALLEL_RENDER_MIN_PAGES:
+        pool = _get_render_pool()
+    if pool is not None:
+        try:
+            for page_num, img in _iter_pdf_pages_pooled(pool, pdf_path, page_count, zoom):
+                yield page_num, img
+                done = page_num
+        except BrokenProcessPool:
+            # 워커가 죽으면 (메모리 부족 등) 남은 페이지는 현재 프로세스에서 렌더링
+            _discard_render_pool(pool)
+
+    yield from _iter_pdf_pages_serial(pdf_path, zoom, start=done)
     gc.collect()
-    return images
 
 
-def images_to_slide_data(image_paths: list) -> list:
+def _iter_pdf_pages_pooled(pool, pdf_path, page_count: int, zoom: float):
+    """
+    페이지 범위를 풀에 제출하고 결과를 순서대로 yield합니다.
+    앞서 렌더링하는 범위는 워커 수까지로 제한합니다.
     """
-    이미지 파일 목록을 SlideData로 변환합니다.
-    (이미지 업로드의 경우, 텍스트 추출 없이 AI 분석 필요)
+    ranges = deque(
+        (start, min(start + RENDER_CHUNK_PAGES, page_count))
+        for start in range(0, page_count, RENDER_CHUNK_PAGES)
+    )
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < _render_pool_workers:
+                start, stop = ranges.popleft()
+                pending.append(pool.submit(_render_page_range, pdf_path, start, stop, zoom))
+            for page_num, width, height, samples in pending.popleft().result():
+                yield page_num + 1, Image.frombytes("RGB", [width, height], samples)
+                samples = None
+    finally:
+        # 소비자가 중간에 멈추면 아직 시작하지 않은 범위는 취소
+        for future in pending:
+            future.cancel()
+
+
+def _iter_pdf_pages_serial(pdf_path, zoom: float, start: int = 0):
+    """현재 프로세스에서 start 페이지부터 차례로 렌더링"""
+    matrix = fitz.Matrix(zoom, zoom)
+    with _open_pdf(pdf_path) as doc:
+        for page_num in range(start, len(doc)):
+            pix = doc[page_num].get_pixmap(matrix=matrix, **PIXMAP_OPTIONS)
+            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+            # pixmap 메모리 즉시 해제
+            pix = None
+            yield page_num + 1, img
 
-    Args:
-        image_paths: 이미지 파일 경로 목록
 
-    Returns:
-        list[SlideData]: 각 이미지의 SlideData (텍스트 없음, page_image만 포함)
+def render_pdf_page(pdf_path, page_index: int, dpi: int = 150) -> Image.Image:
+    """PDF의 한 페이지(0부터 시작)만 PIL Image로 렌더링합니다."""
+    zoom = dpi / 72.0
+    with _open_pdf(pdf_path) as doc:
+        pix = doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), **PIXMAP_OPTIONS)
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+
+class PageAccessor:
     """
-    slides = []
-    for i, path in enumerate(image_paths):
-        img = Image.open(path).convert("RGB")
-        slide = SlideData(
-            page_number=i + 1,
-            width=img.width * 72 / 96,  # px → pt (96dpi 기준)
-            height=img.height * 72 / 96,
-            page_image=img,
-        )
-        slides.append(slide)
-    return slides
+    페이지 인덱스(0부터) → PIL Image 조회 함수.
+    전체 페이지를 들고 있지 않고 최근 maxsize장만 메모리에 유지하며,
+    나머지는 필요할 때 loader로 원본(PDF/이미지 파일)에서 다시 읽습니다.
+    """
+
+    def __init__(self, loader, maxsize: int = 2):
+        self._load = functools.lru_cache(maxsize=maxsize)(loader)
+
+    def __call__(self, page_index: int) -> Image.Image:
+        return self._load(page_index)
+
+    @classmethod
+    def for_pdf(cls, pdf_path, dpi: int = 150, maxsize: int = 2):
+        """PDF 페이지를 필요할 때 렌더링하는 PageAccessor"""
+        return cls(lambda i: render_pdf_page(pdf_path, i, dpi=dpi), maxsize=maxsize)
+
+    @classmethod
+    def for_images(cls, image_paths: list, maxsize: int = 2):
+        """업로드 이미지를 필요할 때 다시 여는 PageAccessor"""
+        return cls(lambda i: load_image(image_paths[i]) if i < len(image_paths) else None,
+                   maxsize=maxsize)
+
+
+def load_image(path) -> Image.Image:
+    """이미지 파일 경로 또는 바이트를 RGB PIL Image로 엽니다."""
+    if isinstance(path, (bytes, bytearray)):
+        img = Image.open(io.BytesIO(path))
+    else:
+        img = Image.open(path)
+    # 큰 JPEG는 축소 디코딩하여 변환/리사이즈 비용 절감
+    img.draft("RGB", (UPLOAD_DRAFT_DIM, UPLOAD_DRAFT_DIM))
+    return img.convert("RGB")
+
+
+def iter_images(image_paths: list):
+    """이미지를 한 장씩 열어 yield (전체 목록을 메모리에 두지 않음)"""
+    for path in image_paths:
+        yield load_image(path)
@@ -4,21 +4,73 @@ PPTX 빌더 모듈
 - 텍스트 박스, 이미지, 도형을 정확한 위치에 배치
 """
 
+import pptx
 from pptx import Presentation
 from pptx.util import Inches, Pt, Emu
 from pptx.dml.color import RGBColor
-from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn
 from PIL import Image
+from xml.sax.saxutils import escape
+import functools
 import io
 import os
+import re
+import zipfile
 
 
 # pt를 EMU로 변환 (1pt = 12700 EMU)
 PT_TO_EMU = 12700
 
-
+# 16:9 표준 크기 (13.333" x 7.5")
+SLIDE_WIDTH_16_9 = Inches(13.333)
+SLIDE_HEIGHT_16_9 = Inches(7.5)
+
+# python-pptx 기본 템플릿을 한 번만 읽어두고 빌드마다 메모리에서 엶
+with open(os.path.join(os.path.dirname(pptx.__file__), "templates", "default.pptx"), "rb") as _f:
+    _TEMPLATE = _f.read()
+
+# PPTX에 넣는 (알파 없는) 이미지의 JPEG 품질
+PPTX_JPEG_QUALITY = 85
+
+# 배경 이미지 폴백을 python-pptx 객체 모델 대신 zip 직접 작성으로 생성
+USE_FAST_PPTX = os.environ.get("USE_FAST_PPTX", "True").lower() == "true"
+
+_NS_RELS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+# 그림 하나만 있는 슬라이드 XML
+_PICTURE_SLIDE_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<p:sld xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+    'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main">'
+    '<p:cSld><p:spTree>'
+    '<p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr>'
+    '<p:grpSpPr/>'
+    '<p:pic><p:nvPicPr><p:cNvPr id="2" name="Picture 1"/>'
+    '<p:cNvPicPr><a:picLocks noChangeAspect="1"/></p:cNvPicPr><p:nvPr/></p:nvPicPr>'
+    '<p:blipFill><a:blip r:embed="rId2"/><a:stretch><a:fillRect/></a:stretch></p:blipFill>'
+    '<p:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+    '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></p:spPr></p:pic>'
+    '</p:spTree></p:cSld>'
+    '<p:clrMapOvr><a:masterClrMapping/></p:clrMapOvr></p:sld>'
+)
+
+_PICTURE_SLIDE_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="' + _NS_RELS + '/slideLayout" Target="../{layout}"/>'
+    '<Relationship Id="rId2" Type="' + _NS_RELS + '/image" Target="../media/{media}"/>'
+    '</Relationships>'
+)
+
+
+@functools.lru_cache(maxsize=1024)
 def _hex_to_rgb(hex_color: str) -> RGBColor:
-    """hex 색상 코드를 RGBColor로 변환"""
+    """
+    hex 색상 코드를 RGBColor로 변환
+    (RGBColor는 불변 tuple이므로 캐시된 객체를 공유해도 안전)
+    """
     hex_color = hex_color.lstrip("#")
     if len(hex_color) != 6:
         return RGBColor(0, 0, 0)
@@ -28,14 +80,84 @@ def _hex_to_rgb(hex_color: str) -> RGBColor:
     return RGBColor(r, g, b)
 
 
-def _alignment(align_str: str):
-    """문자열 정렬을 python-pptx 정렬 상수로 변환"""
-    mapping = {
-        "left": PP_ALIGN.LEFT,
-        "center": PP_ALIGN.CENTER,
-        "right": PP_ALIGN.RIGHT,
+def _new_prs():
+    """기본 템플릿으로 새 프레젠테이션 생성"""
+    return Presentation(io.BytesIO(_TEMPLATE))
+
+
+def _encode_for_pptx(img: Image.Image):
+    """
+    PPTX 삽입용으로 이미지를 인코딩합니다.
+    투명도가 있을 수 있는 이미지만 PNG, 나머지는 더 작고 빠른 JPEG로 저장합니다.
+
+    Returns:
+        (bytes, 확장자)
+    """
+    stream = io.BytesIO()
+    if img.mode in ("RGBA", "LA", "P"):
+        img.save(stream, format="PNG")
+        return stream.getvalue(), "png"
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.save(stream, format="JPEG", quality=PPTX_JPEG_QUALITY)
+    return stream.getvalue(), "jpeg"
+
+
+# AI 텍스트 요소용 문단 XML 템플릿 (줄마다 python-pptx 접근자를 거치지 않도록 한 번에 생성)
+_PARAGRAPH_XML = '<a:p><a:pPr algn="{algn}"/><a:r>{rpr}<a:t>{text}</a:t></a:r></a:p>'
+_EMPTY_PARAGRAPH_XML = '<a:p><a:pPr algn="{algn}"/>{end_rpr}</a:p>'
+_RUN_PROPS_XML = (
+    '<a:{tag} sz="{sz}" b="{b}" i="{i}">'
+    '<a:solidFill><a:srgbClr val="{color}"/></a:solidFill></a:{tag}>'
+)
+_ALIGN_ATTR = {"left": "l", "center": "ctr", "right": "r"}
+
+# XML 1.0에서 허용되지 않는 제어 문자
+_INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _set_textbody(txBox, lines, font_size, color, bold, italic, alignment):
+    """
+    텍스트 박스의 문단(<a:p>)들을 줄 목록으로 한 번에 교체합니다.
+    모든 줄이 같은 서식이므로 글자 속성 XML을 한 번만 만들어 재사용합니다.
+    """
+    fmt = {
+        "sz": min(max(int(font_size * 100), 100), 400000),  # 스키마 허용 범위 (1-4000pt)
+        "b": "1" if bold else "0",
+        "i": "1" if italic else "0",
+        "color": str(_hex_to_rgb(color)),
     }
-    return mapping.get(align_str, PP_ALIGN.LEFT)
+    rpr = _RUN_PROPS_XML.format(tag="rPr", **fmt)
+    end_rpr = _RUN_PROPS_XML.format(tag="endParaRPr", **fmt)
+    algn = _ALIGN_ATTR.get(alignment, "l")
+
+    paragraphs = []
+    for line_text in lines:
+        if line_text:
+            text = escape(_INVALID_XML_CHARS.sub("", line_text))
+            paragraphs.append(_PARAGRAPH_XML.format(algn=algn, rpr=rpr, text=text))
+        else:
+            paragraphs.append(_EMPTY_PARAGRAPH_XML.format(algn=algn, end_rpr=end_rpr))
+
+    txBody = txBox.text_frame._txBody
+    for p in txBody.findall(qn("a:p")):
+        txBody.remove(p)
+    new_body = parse_xml(f'<a:txBody {nsdecls("a")}>{"".join(paragraphs)}</a:txBody>')
+    for p in list(new_body):
+        txBody.append(p)
+
+
+def _page_getter(page_images):
+    """페이지 이미지 목록 또는 인덱스 → 이미지 함수를 일관된 조회 함수로 변환"""
+    if callable(page_images):
+        return page_images
+
+    def get_page(i):
+        if i < len(page_images):
+            return page_images[i]
+        return None
+
+    return get_page
 
 
 def build_pptx_from_pdf_data(slides_data: list, output_path: str) -> str:
@@ -52,7 +174,7 @@ def build_pptx_from_pdf_data(slides_data: list, output_path: str) -> str:
     if not slides_data:
         raise ValueError("슬라이드 데이터가 비어있습니다.")
 
-    prs = Presentation()
+    prs = _new_prs()
 
     # 첫 슬라이드 크기 기준으로 프레젠테이션 크기 설정
     first = slides_data[0]
@@ -103,11 +225,8 @@ def build_pptx_from_pdf_data(slides_data: list, output_path: str) -> str:
             height = int(ib.height * PT_TO_EMU)
 
             # PIL Image → bytes
-            img_stream = io.BytesIO()
-            ib.image.save(img_stream, format="PNG")
-            img_stream.seek(0)
-
-            slide.shapes.add_picture(img_stream, left, top, width, height)
+            img_bytes, _ = _encode_for_pptx(ib.image)
+            slide.shapes.add_picture(io.BytesIO(img_bytes), left, top, width, height)
 
     prs.save(output_path)
     return output_path
@@ -118,8 +237,9 @@ def build_pptx_from_ai_data(layouts: list, page_images: list, output_path: str)
     AI Vision 분석 결과로 PPTX를 생성합니다.
 
     Args:
-        layouts: ai_analyzer.analyze_slides_batch()의 결과
-        page_images: 원본 페이지 이미지 (이미지 요소 및 폴백용)
+        layouts: ai_analyzer.analyze_slides_grouped()의 결과
+        page_images: 원본 페이지 이미지 목록, 또는 페이지 인덱스를 받아 이미지를
+            반환하는 함수 (이미지 요소가 있는 슬라이드에서만 호출됨)
         output_path: 출력 PPTX 파일 경로
 
     Returns:
@@ -128,19 +248,21 @@ def build_pptx_from_ai_data(layouts: list, page_images: list, output_path: str)
     if not layouts:
         raise ValueError("레이아웃 데이터가 비어있습니다.")
 
-    prs = Presentation()
+    prs = _new_prs()
 
-    # 16:9 표준 크기 (10" x 5.625")
-    prs.slide_width = Inches(13.333)
-    prs.slide_height = Inches(7.5)
+    # 16:9 표준 크기
+    prs.slide_width = SLIDE_WIDTH_16_9
+    prs.slide_height = SLIDE_HEIGHT_16_9
 
     slide_w = prs.slide_width
     slide_h = prs.slide_height
 
     blank_layout = prs.slide_layouts[6]
+    get_page = _page_getter(page_images)
 
     for i, layout in enumerate(layouts):
         slide = prs.slides.add_slide(blank_layout)
+        orig = None  # 이미지 요소가 있을 때만 원본 페이지를 가져옴
 
         # 배경색 설정
         bg = slide.background
@@ -164,20 +286,12 @@ def build_pptx_from_ai_data(layouts: list, page_images: list, output_path: str)
                 tf = txBox.text_frame
                 tf.word_wrap = True
 
-                # 여러 줄 텍스트 처리
+                # 여러 줄 텍스트 처리 (줄마다 문단 하나)
                 lines = elem.content.split("\n")
-                for line_idx, line_text in enumerate(lines):
-                    if line_idx == 0:
-                        p = tf.paragraphs[0]
-                    else:
-                        p = tf.add_paragraph()
-
-                    p.text = line_text
-                    p.font.size = Pt(elem.font_size)
-                    p.font.color.rgb = _hex_to_rgb(elem.font_color)
-                    p.font.bold = elem.bold
-                    p.font.italic = elem.italic
-                    p.alignment = _alignment(elem.alignment)
+                _set_textbody(
+                    txBox, lines, elem.font_size, elem.font_color,
+                    elem.bold, elem.italic, elem.alignment,
+                )
 
             elif elem.type == "shape":
                 # 도형 (사각형) 추가
@@ -192,8 +306,9 @@ def build_pptx_from_ai_data(layouts: list, page_images: list, output_path: str)
 
             elif elem.type == "image":
                 # 원본 이미지에서 해당 영역 크롭하여 배치
-                if i < len(page_images) and page_images[i] is not None:
-                    orig = page_images[i]
+                if orig is None:
+                    orig = get_page(i)
+                if orig is not None:
                     # 백분율 → 픽셀 좌표
                     crop_x = int(orig.width * elem.x / 100)
                     crop_y = int(orig.height * elem.y / 100)
@@ -208,41 +323,117 @@ def build_pptx_from_ai_data(layouts: list, page_images: list, output_path: str)
 
                     if crop_r > crop_x and crop_b > crop_y:
                         cropped = orig.crop((crop_x, crop_y, crop_r, crop_b))
-                        img_stream = io.BytesIO()
-                        cropped.save(img_stream, format="PNG")
-                        img_stream.seek(0)
-                        slide.shapes.add_picture(img_stream, left, top, width, height)
+                        img_bytes, _ = _encode_for_pptx(cropped)
+                        slide.shapes.add_picture(io.BytesIO(img_bytes), left, top, width, height)
 
     prs.save(output_path)
     return output_path
 
 
+@functools.lru_cache(maxsize=1)
+def _picture_deck_template():
+    """
+    슬라이드가 없는 16:9 기본 프레젠테이션을 한 번만 만들어
+    (파트 이름 → 바이트, 빈 레이아웃 파트 경로, 슬라이드 크기)로 보관합니다.
+    """
+    prs = _new_prs()
+    prs.slide_width = SLIDE_WIDTH_16_9
+    prs.slide_height = SLIDE_HEIGHT_16_9
+    blank_layout = prs.slide_layouts[6].part.partname.lstrip("/")
+
+    buf = io.BytesIO()
+    prs.save(buf)
+    with zipfile.ZipFile(buf) as zf:
+        parts = {name: zf.read(name) for name in zf.namelist()}
+    # presentation.xml 상대 경로 (ppt/slideLayouts/... → slideLayouts/...)
+    blank_layout = blank_layout.split("/", 1)[1]
+    return parts, blank_layout, int(prs.slide_width), int(prs.slide_height)
+
+
+def _build_background_pptx_fast(page_images, output_path: str) -> str:
+    """zip 파트를 직접 작성하여 배경 이미지 슬라이드만으로 된 PPTX를 만듭니다."""
+    parts, blank_layout, cx, cy = _picture_deck_template()
+    slide_xml = _PICTURE_SLIDE_XML.format(cx=cx, cy=cy)
+
+    sld_ids = []
+    pres_rels = []
+    overrides = []
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        n = 0
+        for n, img in enumerate(page_images, start=1):
+            img_bytes, ext = _encode_for_pptx(img)
+            media = f"image{n}.{ext}"
+            # 이미 압축된 이미지는 다시 deflate하지 않음
+            zf.writestr(f"ppt/media/{media}", img_bytes,
+                        compress_type=zipfile.ZIP_STORED)
+            img_bytes = None
+
+            zf.writestr(f"ppt/slides/slide{n}.xml", slide_xml)
+            zf.writestr(
+                f"ppt/slides/_rels/slide{n}.xml.rels",
+                _PICTURE_SLIDE_RELS.format(layout=blank_layout, media=media),
+            )
+            sld_ids.append(f'<p:sldId id="{255 + n}" r:id="rIdSlide{n}"/>')
+            pres_rels.append(
+                f'<Relationship Id="rIdSlide{n}" Type="{_NS_RELS}/slide" '
+                f'Target="slides/slide{n}.xml"/>'
+            )
+            overrides.append(
+                f'<Override PartName="/ppt/slides/slide{n}.xml" ContentType='
+                '"application/vnd.openxmlformats-officedocument.presentationml.slide+xml"/>'
+            )
+
+        for name, data in parts.items():
+            if name == "ppt/presentation.xml" and sld_ids:
+                data = data.replace(
+                    b"</p:sldMasterIdLst>",
+                    b"</p:sldMasterIdLst><p:sldIdLst>"
+                    + "".join(sld_ids).encode() + b"</p:sldIdLst>",
+                    1,
+                )
+            elif name == "ppt/_rels/presentation.xml.rels":
+                data = data.replace(
+                    b"</Relationships>",
+                    "".join(pres_rels).encode() + b"</Relationships>",
+                )
+            elif name == "[Content_Types].xml":
+                data = data.replace(
+                    b"<Default ",
+                    b'<Default Extension="png" ContentType="image/png"/><Default ',
+                    1,
+                ).replace(b"</Types>", "".join(overrides).encode() + b"</Types>")
+            zf.writestr(name, data)
+
+    return output_path
+
+
 def build_pptx_with_background_images(page_images: list, output_path: str) -> str:
     """
     최종 폴백: 각 페이지 이미지를 슬라이드 배경으로 삽입합니다.
     (AI 분석도 실패한 경우의 보험)
 
     Args:
-        page_images: 페이지 이미지 목록
+        page_images: 페이지 이미지 목록 (또는 이터러블)
         output_path: 출력 PPTX 파일 경로
 
     Returns:
         str: 생성된 PPTX 파일 경로
     """
-    prs = Presentation()
-    prs.slide_width = Inches(13.333)
-    prs.slide_height = Inches(7.5)
+    if USE_FAST_PPTX:
+        return _build_background_pptx_fast(page_images, output_path)
+
+    prs = _new_prs()
+    prs.slide_width = SLIDE_WIDTH_16_9
+    prs.slide_height = SLIDE_HEIGHT_16_9
 
     blank_layout = prs.slide_layouts[6]
 
     for img in page_images:
         slide = prs.slides.add_slide(blank_layout)
-        img_stream = io.BytesIO()
-        img.save(img_stream, format="PNG")
-        img_stream.seek(0)
+        img_bytes, _ = _encode_for_pptx(img)
 
         slide.shapes.add_picture(
-            img_stream, 0, 0,
+            io.BytesIO(img_bytes), 0, 0,
             prs.slide_width, prs.slide_height
         )
 
@@ -27,6 +27,11 @@
 
     let selectedFiles = [];
 
+    // 비동기 작업 상태 조회 간격 / 최대 대기 시간
+    // (Celery는 없거나 만료된 작업 ID도 PENDING으로 응답하므로 기한을 둠)
+    const POLL_INTERVAL_MS = 1500;
+    const POLL_TIMEOUT_MS = 10 * 60 * 1000;
+
     // --- 유틸리티 ---
     function formatFileSize(bytes) {
         if (bytes < 1024) return bytes + ' B';
@@ -209,14 +214,15 @@
         xhr.addEventListener('load', () => {
             clearInterval(serverProgressInterval);
 
-            if (xhr.status === 200) {
+            if (xhr.status === 200 || xhr.status === 202) {
                 try {
                     const data = JSON.parse(xhr.responseText);
-                    if (data.success) {
-                        setProgress(100, '완료!', '');
-                        setTimeout(() => {
-                            showResult(data);
-                        }, 500);
+                    if (data.success && data.status_url) {
+                        // 워커에서 처리 중: 완료될 때까지 상태 조회
+                        simulateServerProgress();
+                        pollStatus(data.status_url, Date.now() + POLL_TIMEOUT_MS);
+                    } else if (data.success) {
+                        finishConversion(data);
                     } else {
                         showError(data.error || '변환에 실패했습니다.');
                         showState('preview');
@@ -246,6 +252,39 @@
         xhr.send(formData);
     }
 
+    function finishConversion(data) {
+        clearInterval(serverProgressInterval);
+        setProgress(100, '완료!', '');
+        setTimeout(() => {
+            showResult(data);
+        }, 500);
+    }
+
+    function pollStatus(statusUrl, deadline) {
+        fetch(statusUrl)
+            .then((res) => res.json())
+            .then((data) => {
+                if (data.status === 'SUCCESS') {
+                    finishConversion(data.result);
+                } else if (data.status === 'FAILURE' || data.error) {
+                    clearInterval(serverProgressInterval);
+                    showError(data.error || '변환에 실패했습니다.');
+                    showState('preview');
+                } else if (Date.now() > deadline) {
+                    clearInterval(serverProgressInterval);
+                    showError('변환이 너무 오래 걸립니다. 잠시 후 다시 시도해주세요.');
+                    showState('preview');
+                } else {
+                    setTimeout(() => pollStatus(statusUrl, deadline), POLL_INTERVAL_MS);
+                }
+            })
+            .catch(() => {
+                clearInterval(serverProgressInterval);
+                showError('네트워크 오류가 발생했습니다. 서버가 실행 중인지 확인해주세요.');
+                showState('preview');
+            });
+    }
+
     let serverProgressInterval = null;
 
     function simulateServerProgress() {